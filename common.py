@@ -5,11 +5,21 @@ paradigm followed in each of the other module-scripts in args.
 """
 
 import os, os.path as op
+import sys
+import errno
+import shutil
+import fcntl
 import subprocess as sp
 import re
+import select
 import logging
 log = logging.getLogger()
 
+# Linux pipes default to 64 KiB; a chatty FSL tool blocks on write whenever we
+# fall that far behind draining it.  1 MiB is the default unprivileged maximum.
+PIPE_SIZE = 1024 * 1024
+F_SETPIPE_SZ = 1031
+
 
 def build_command_list(command, ParamList, include_keys=True):
     """
@@ -18,37 +28,112 @@ def build_command_list(command, ParamList, include_keys=True):
      list as such ("-k value" or "--key=value")
     include_keys indicates whether to include the key-names with the command (True)
     """
-    for key in ParamList.keys():
-        # Single character command-line parameters are preceded by a single '-'
+    for key, value in ParamList.items():
+        is_bool = type(value) == bool
+        str_value = '' if is_bool else str(value)
+
+        # Single character command-line parameters are preceded by a single '-',
+        # and are left out altogether when not including keys
         if len(key) == 1:
-            if include_keys:
-                # If Param is boolean and true include, else exclude
-                if type(ParamList[key]) == bool or len(str(ParamList[key])) == 0:
-                    if ParamList[key] and include_keys:
-                        command.append('-' + key)
-                else:
+            if not include_keys:
+                continue
+            # Booleans and empty values are flags: include when true, else exclude
+            if is_bool or str_value == '':
+                if value:
                     command.append('-' + key)
-                    command.append(str(ParamList[key]))
+            else:
+                command.append('-' + key)
+                command.append(str_value)
         # Multi-Character command-line parameters are preceded by a double '--'
-        else:
-            # If Param is boolean and true include, else exclude
-            if type(ParamList[key]) == bool:
-                if ParamList[key] and include_keys:
-                    command.append('--' + key)
+        # If Param is boolean and true include, else exclude
+        elif is_bool:
+            if value and include_keys:
+                command.append('--' + key)
+        # If Param not boolean, but without value include without value
+        # (e.g. '--key'), else include value (e.g. '--key=value')
+        elif include_keys:
+            if str_value:
+                command.append('--' + key + '=' + str_value)
             else:
-                # If Param not boolean, but without value include without value
-                # (e.g. '--key'), else include value (e.g. '--key=value')
-                item = ""
-                if include_keys:
-                    item = '--' + key
-                if len(str(ParamList[key])) > 0:
-                    if include_keys:
-                        item = item + "="
-                    item = item + str(ParamList[key])
-                command.append(item)
+                command.append('--' + key)
+        else:
+            command.append(str_value)
     return command
 
 
+def spawn_command(command, shell=False, **kwargs):
+    """
+    Starts a command with its stdout and stderr piped back to us, using
+    PIPE_SIZE pipe buffers. Parameters are
+    - command: list of command-line parameters (a string when shell is True)
+    - shell: whether or not to execute as a single shell string
+    - kwargs: any other arguments to pass on to sp.Popen
+    Returns the sp.Popen object
+    """
+    if sys.version_info >= (3, 10):
+        return sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=shell,
+                        pipesize=PIPE_SIZE, **kwargs)
+
+    process = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=shell,
+                       **kwargs)
+    for pipe in (process.stdout, process.stderr):
+        try:
+            fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, PIPE_SIZE)
+        except OSError:
+            # The pipe keeps its default size if the kernel won't allow this one
+            pass
+    return process
+
+
+def stream_output(process, chunk_size=65536):
+    """
+    Logs a running process's stdout as it arrives, and collects
+    its stderr.  Both pipes are polled and read without blocking, so a partial
+    line never stalls the loop and a full stderr pipe can't block the child
+    while we wait on stdout. Parameters are
+    - process: a sp.Popen object with stdout and stderr pipes
+    - chunk_size: the most bytes to read from a pipe at once
+    Returns the stderr output of the process
+    """
+    stdout_fd = process.stdout.fileno()
+    stderr_fd = process.stderr.fileno()
+    buffers = {stdout_fd: bytearray(), stderr_fd: bytearray()}
+
+    poller = select.poll()
+    for fd in buffers:
+        os.set_blocking(fd, False)
+        poller.register(fd, select.POLLIN | select.POLLHUP)
+
+    open_fds = set(buffers)
+    while open_fds:
+        for fd, event in poller.poll():
+            try:
+                chunk = os.read(fd, chunk_size)
+            except BlockingIOError:
+                continue
+
+            # An empty read means the child closed its end of the pipe
+            if not chunk:
+                poller.unregister(fd)
+                open_fds.discard(fd)
+                continue
+
+            buffers[fd] += chunk
+
+            # Log everything up to the last complete line as one record, and
+            # keep any partial line for the next read
+            if fd == stdout_fd:
+                end = buffers[fd].rfind(b'\n')
+                if end >= 0:
+                    log.info('%s', buffers[fd][:end].decode(errors='replace'))
+                    del buffers[fd][:end + 1]
+
+    if buffers[stdout_fd]:
+        log.info(buffers[stdout_fd].decode(errors='replace'))
+
+    return buffers[stderr_fd].decode(errors='replace')
+
+
 def exec_command(command, shell=False, stdout_msg=None, cont_output=False):
     """
     This is a generic abstraction to execute shell commands using the subprocess
@@ -67,8 +152,7 @@ def exec_command(command, shell=False, stdout_msg=None, cont_output=False):
     else:
         run_command = command
 
-    result = sp.Popen(run_command, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
+    result = spawn_command(run_command, shell=shell, universal_newlines=True)
 
     # log that we are using an alternate stdout message
     if stdout_msg != None:
@@ -77,13 +161,8 @@ def exec_command(command, shell=False, stdout_msg=None, cont_output=False):
     # if continuous stdout is desired... and we are not redirecting output
     if cont_output and not (shell and ('>' in command)) \
             and (stdout_msg == None):
-        while True:
-            stdout = result.stdout.readline()
-            if stdout == '' and result.poll() is not None:
-                break
-            if stdout:
-                log.info(stdout)
-        returncode = result.poll()
+        stderr = stream_output(result)
+        returncode = result.wait()
 
     else:
         stdout, stderr = result.communicate()
@@ -93,9 +172,27 @@ def exec_command(command, shell=False, stdout_msg=None, cont_output=False):
 
     log.info('Command return code: {}'.format(returncode))
 
-    if result.returncode != 0:
+    if returncode != 0:
         log.error('The command:\n ' +
                   ' '.join(command) +
                   '\nfailed. with:\n' +
                   stderr)
-        raise Exception(stderr)
\ No newline at end of file
+        raise Exception(stderr)
+
+
+def move_file(source, destination):
+    """
+    Moves a file with a single rename, which is atomic when the source and
+    destination are on the same filesystem (e.g. work/ and output/ under
+    /flywheel/v0).  Falls back to shutil.move to copy across filesystems.
+    Parameters are
+    - source: path of the file to move
+    - destination: the file's new path
+    """
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, destination)
+
@@ -1,119 +1,175 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess as sp
 import logging
-import matplotlib.pyplot as pl
-import matplotlib.image as mpm
-pl.switch_backend('agg')
+from concurrent.futures import ThreadPoolExecutor
+from common import spawn_command
+import nibabel as nb
+import numpy as np
+from scipy.ndimage import binary_dilation
+from PIL import Image
 
 fsldir='/usr/lib/fsl/5.0'
+BET2 = os.path.join(fsldir, 'bet2')
+
+# The fixed parts of the QA command lines; each call only fills in its files (and bet2's center of mass)
+BET2_OPTIONS = ('-m', '-t', '-f', '0.5', '-w', '0.4')
+SLICER_OPTIONS = ('-c', '-s', '3')
+OVERLAY_RANGE = ('0.001', '5')
 log = logging.getLogger()
 
 
 
-def bet(image,workdir,shell=False):
+def run_command(cmd):
     """
-    Runs fsl's bet2 on an image and saves the results in workdir
+    Runs a command to completion, logging the command and its output at debug level.  A failing command has its
+    stderr logged as an error and raises an Exception.
     Args:
-        image (str): path to the image to run bet2 on
-        workdir (str): path for bet2 output (used to generate <output_fileroot> option in bet2
-        shell (bool): pass the shell into the bet2 subprocess command
+        cmd (list): the command to run
+
     Returns:
-        bet_out (str): path to bet2's <output_fileroot> (currently "workdir"/bet
+        out (str): the command's stdout
     """
 
+    log.debug('Running: %s', ' '.join(cmd))
+    result = spawn_command(cmd, universal_newlines=True)
 
+    out, err = result.communicate()
+    log.debug('stdout: %s\nstderr: %s', out, err)
 
-    com_cmd = ['{}/fslstats'.format(fsldir), image, '-C']
+    if result.returncode != 0:
+        log.error('The command:\n %s\nfailed with return code %s:\n%s', ' '.join(cmd), result.returncode, err)
+        raise Exception(err)
 
-    print(' '.join(com_cmd))
-    com_cmd = ' '.join(com_cmd)
+    return(out)
 
-    result = sp.Popen(com_cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
 
-    out, err = result.communicate()
-    print(out)
-    print(err)
-    center_of_mass = out.rstrip()
+def image_center_of_mass(image):
+    """
+    Calculates the intensity weighted center of gravity of an image in voxel coordinates (what "fslstats -C"
+    reports, and what bet2's "-c" option expects)
+    Args:
+        image (str): path to the image.  If it's 4D, only the first volume is used
 
-    bet_out = os.path.join(workdir, 'bet')
-    bet_cmd = ['{}/bet2'.format(fsldir), image, bet_out, '-o', '-m', '-t', '-f', '0.5', '-w', '0.4', '-c', center_of_mass]
-    print(' '.join(bet_cmd))
-    bet_cmd = ' '.join(bet_cmd)
-    result = sp.Popen(bet_cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
+    Returns:
+        com_vox (numpy.ndarray): x, y, z of the center of gravity in voxels
+    """
 
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    # Keep the data in its stored type (memory mapped for uncompressed images) rather than a full float copy
+    img = nb.load(image, mmap=True)
+    data = np.asanyarray(img.dataobj[..., 0] if len(img.shape) > 3 else img.dataobj)
+
+    # Like fslstats, weight each voxel by its intensity above the volume's minimum, so the negative voxels in
+    # applytopup's spline interpolated output don't pull the center away from the brain
+    vmin = float(data.min())
 
+    # Accumulate the moments one slice at a time, so only a slice is ever converted to float
+    nx, ny, nz = data.shape[:3]
+    x = np.arange(nx, dtype=np.float64)
+    y = np.arange(ny, dtype=np.float64)
+    mass = 0.0
+    moments = np.zeros(3)
+    for z in range(nz):
+        plane = data[:, :, z].astype(np.float64) - vmin
+        plane_mass = plane.sum()
+        mass += plane_mass
+        moments += (x @ plane.sum(axis=1), y @ plane.sum(axis=0), z * plane_mass)
+
+    com_vox = moments / mass
+
+    return(com_vox)
+
+
+def bet(image,workdir):
+    """
+    Runs fsl's bet2 on an image and saves the results in workdir.
+    Args:
+        image (str): path to the image to run bet2 on
+        workdir (str): path for bet2 output (used to generate <output_fileroot> option in bet2
+    Returns:
+        bet_out (str): path to bet2's <output_fileroot> (currently "workdir"/bet
+    """
+
+    center_of_mass = ['{:.6f}'.format(c) for c in image_center_of_mass(image)]
+
+    bet_out = os.path.join(workdir, 'bet')
+    bet_cmd = [BET2, image, bet_out, *BET2_OPTIONS, '-c', *center_of_mass]
+    run_command(bet_cmd)
 
     return(bet_out)
 
 
-def bet_2_outline(original,bet_root,shell=False):
+def bet_2_outline(bet_root):
     """
-    Takes a bet2 extracted image and it's original, and creates a mask of the outline.  Requires that the "-o" option
-    was used during bet2 to generate an overlay image.
+    Takes a bet2 brain mask and creates a mask of its outline (the ring of voxels just outside the brain).  Requires
+    that the "-m" option was used during bet2 to generate a mask.
     Args:
-        original (str): path to the original image that bet2 was performed on
         bet_root (str): path to the bet2 root (the <output_fileroot> option used in bet2)
-        shell (bool): use the shell in the subprocess commands
 
     Returns:
         bin_out (str): path to the binary bet2 outline mask.
 
     """
 
-    overlay = bet_root+'_overlay.nii.gz'
-    diff_out = bet_root+'_diff'
+    mask_img = nb.load(bet_root+'_mask.nii.gz', mmap=True)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    outline = binary_dilation(mask) & ~mask
 
-    cmd = ['fslmaths', overlay,'-sub',original,diff_out]
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    bin_out = bet_root+'_outline'
+    outline_img = nb.Nifti1Image(outline.astype(np.uint8), mask_img.affine, mask_img.header)
+    outline_img.set_data_dtype(np.uint8)
+    outline_img.to_filename(bin_out+'.nii.gz')
 
-    cmd = ['fslstats', diff_out, '-p', '97']
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    return(bin_out)
 
-    thresh = out.rstrip()
 
-    thresh_out = bet_root+'_thresh'
-    cmd = ['fslmaths',diff_out,'-thr',thresh,thresh_out]
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
-    out, err = result.communicate()
-    print(out)
-    print(err)
 
-    bin_out = bet_root+'_outline'
-    cmd = ['fslmaths', thresh_out, '-bin', bin_out]
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
-    out, err = result.communicate()
-    print(out)
-    print(err)
+def slice_plane(image, plane, png):
+    """
+    Saves a .png of the center slice of an image along one plane using slicer, and decodes it
+    Args:
+        image (str): path to the image to slice
+        plane (str): the plane to slice along ('x', 'y', or 'z')
+        png (str): path to save the .png slice to
 
-    os.remove(thresh_out+'.nii.gz')
-    os.remove(diff_out+'.nii.gz')
+    Returns:
+        slice (numpy.ndarray): the RGB pixels of the saved .png
+    """
 
-    return(bin_out)
+    cmd=['slicer', image, *SLICER_OPTIONS, '-{}'.format(plane), '0.5', png]
+
+    run_command(cmd)
+
+    # Decode here, while the other planes are still being sliced, rather than after all of them are done
+    return(np.asarray(Image.open(png).convert('RGB')))
+
+
+def append_images(images, output, gap=4):
+    """
+    Joins RGB images side by side, top aligned, with a black gap between each, and saves them as a .png (what
+    "pngappend a + 4 b" does)
+    Args:
+        images (list): RGB pixel arrays to join, left to right
+        output (str): path to save the joined .png to
+        gap (int): width of the gap between images, in pixels
 
+    Returns:
+
+    """
 
+    height = max(image.shape[0] for image in images)
+    separator = np.zeros((height, gap, 3), dtype=np.uint8)
 
-def overlay(image1,image2,output,shell=False):
+    columns = []
+    for image in images:
+        if columns:
+            columns.append(separator)
+        columns.append(np.pad(image, ((0, height - image.shape[0]), (0, 0), (0, 0))))
+
+    Image.fromarray(np.hstack(columns)).save(output)
+
+
+def overlay(image1,image2,output):
     """
     creates an overlay of image 2 over image1.  Saves three .pngs of the overlay (one along each plane), and merges
     them into one single .png file
@@ -121,47 +177,27 @@ def overlay(image1,image2,output,shell=False):
         image1 (str): path to image1
         image2 (str): path to image2
         output (str): path to save merged overlays to
-        shell (bool): include the shell in the subprocess commands or not
 
     Returns:
 
     """
 
-    cmd=['overlay','0','0',image1,'-a',image2,'0.001','5',output]
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
+    cmd=['overlay', '0', '0', image1, '-a', image2, *OVERLAY_RANGE, output]
+    run_command(cmd)
 
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    wrkdir, out_base = os.path.split(output)
 
-    wrkdir = os.path.split(output)[0]
+    # The slice pngs are prefixed with the overlay name so that two overlays rendered at the same time in the same
+    # directory don't overwrite each other's slices
+    planes = ['x', 'y', 'z']
+    slices = [os.path.join(wrkdir, '{}_{}0v.png'.format(out_base, plane)) for plane in planes]
 
-    cmd=['slicer',output,'-c','-s','3',
-         '-x','0.5',os.path.join(wrkdir,'x0v.png'),
-         '-y','0.5',os.path.join(wrkdir,'y0v.png'),
-         '-z','0.5',os.path.join(wrkdir,'z0v.png'),]
+    # Each plane is written to its own file, so the three slicer calls can run side by side
+    with ThreadPoolExecutor(max_workers=len(planes)) as executor:
+        futures = [executor.submit(slice_plane, output, plane, png) for plane, png in zip(planes, slices)]
+        images = [future.result() for future in futures]
 
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
-
-    out, err = result.communicate()
-    print(out)
-    print(err)
-
-    cmd=['{}/pngappend'.format(fsldir),os.path.join(wrkdir,'x0v.png'),'+','4',
-         os.path.join(wrkdir,'y0v.png'),'+','4',
-         os.path.join(wrkdir,'z0v.png'),output+'.png']
-
-    print(' '.join(cmd))
-    result = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE,
-                      universal_newlines=True, shell=shell)
-
-    out, err = result.communicate()
-    print(out)
-    print(err)
+    append_images(images, output+'.png')
 
 
 def outline_overlay(background, outline, name=''):
@@ -189,13 +225,14 @@ def outline_overlay(background, outline, name=''):
     else:
         work_base = os.path.split(name)[0]
 
-    workdir = os.path.join(work_base, 'outline_work')
+    # Each overlay gets its own work directory so that overlays generated concurrently don't share bet2 outputs
+    workdir = os.path.join(work_base, '{}_work'.format(os.path.basename(name)))
     os.makedirs(workdir, exist_ok=True)
 
-    bet_out = bet(outline, workdir, True)
+    bet_out = bet(outline, workdir)
 
-    mask_outline = bet_2_outline(outline, bet_out, shell=False)
-    overlay(background, mask_outline, name, shell=False)
+    mask_outline = bet_2_outline(bet_out)
+    overlay(background, mask_outline, name)
 
 
 def plot_overlays(files, titles, output):
@@ -214,21 +251,26 @@ def plot_overlays(files, titles, output):
         log.warning('Number of files different than number of provided titles')
         return
 
-    f, ax = pl.subplots(len(files), 1)
+    # matplotlib is only needed here, so only import it (and pick its backend) once we plot
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as pl
+    import matplotlib.image as mpm
+
+    # Decode the pngs side by side before plotting
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        images = list(executor.map(lambda file: mpm.imread(file+'.png'), files))
 
-    for ai, a in enumerate(ax):
-        file = files[ai]
-        title = titles[ai]
-        image = mpm.imread(file+'.png')
+    fig, ax = pl.subplots(len(files), 1, squeeze=False, constrained_layout=True)
+
+    for a, image, title in zip(ax.flatten(), images, titles):
         a.imshow(image)
         a.set_title(title)
         a.set_xticks([])
         a.set_yticks([])
 
-    pl.tight_layout()
-
-    pl.savefig(output)
-    pl.close()
+    fig.savefig(output)
+    pl.close(fig)
 
 def generate_topup_report(original_image, corrected_image, output_base=''):
     """
@@ -252,13 +294,18 @@ def generate_topup_report(original_image, corrected_image, output_base=''):
 
     original_base = original_base[:original_base.find('.nii.gz')]
 
-    log.info('overlay 1')
-    name1 = os.path.join(output_base, 'corrected_over_original')
-    outline_overlay(original_image, corrected_image, name1)
+    # Overlay names include the original's name, so reports generated at the same time don't share files
+    name1 = os.path.join(output_base, '{}_corrected_over_original'.format(original_base))
+    name2 = os.path.join(output_base, '{}_original_over_corrected'.format(original_base))
 
-    log.info('overlay 2')
-    name2 = os.path.join(output_base,'original_over_corrected')
-    outline_overlay(corrected_image, original_image, name2)
+    # The two overlays share no files, so generate them concurrently.  The report waits on both.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        log.info('overlay 1')
+        overlay1 = executor.submit(outline_overlay, original_image, corrected_image, name1)
+        log.info('overlay 2')
+        overlay2 = executor.submit(outline_overlay, corrected_image, original_image, name2)
+        overlay1.result()
+        overlay2.result()
 
     log.info('generating report')
     report_out = os.path.join(output_base,'{}_QA_report.png'.format(original_base))
@@ -268,26 +315,19 @@ def generate_topup_report(original_image, corrected_image, output_base=''):
 
 
 
-# def debug1():
-#     background = '/Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/work/Image1.nii.gz'
-#     outline = '/Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/output/topup_corrected_nodif.nii.gz'
-#     name1 = '/Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/work/topup_over_orig'
-#     outline_overlay(background, outline, name1)
-#
-#     name2 = '/Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/work/orig_over_topup'
-#     outline_overlay(outline, background, name2)
-#
-#     report_out = '/Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/work/report_out.png'
-#     plot_overlays([name1, name2], ['topup (red) over original', 'original (red) over topup'], report_out)
+def debug(file_comparison):
+    """
+    Regenerates the QA reports from the files left by a gear run inside the container, to debug the QA steps on
+    their own.  Only runs when the MRI_QA_DEBUG environment variable is set, e.g.:
+        MRI_QA_DEBUG=1 python3 mri_qa.py <original 1> <corrected 1> [<original 2> <corrected 2> ...]
+    Args:
+        file_comparison (list): (original, corrected) image path pairs to generate reports for
 
+    Returns:
 
-def debug2():
-    #cmd = "drun -v /Users/davidparker/Documents/Flywheel/SSE/MyWork/Gears/Topup/Gear/fsl-topup:/flywheel/v0 flywheel/fsl-topup:0.0.4"
+    """
     import shutil
 
-    # file_comparison = [(apply_to_files[i][0], corrected_files[i]) for i in range(len(corrected_files))]
-
-    file_comparison = [('/flywheel/v0/work/Image1.nii.gz', '/flywheel/v0/output/topup-corrected-nodif.nii.gz'), ('/flywheel/v0/work/Image2.nii.gz', '/flywheel/v0/output/topup-corrected-nodif_PA.nii.gz')]
     log.info('Running Topup QA')
 
     work_dir = '/flywheel/v0/work'
@@ -298,22 +338,11 @@ def debug2():
         report_dir, report_base = os.path.split(report_out)
         shutil.move(report_out, os.path.join(output_dir, report_base))
 
-        # Move the config file used in the analysis to the output
-        config_path = '/flywheel/v0/output/config_file.txt'
-        config_out =  '/flywheel/v0/output/config_file.txt'
-
-        if not config_path:
-            config_path = DEFAULT_CONFIG
-        if os.path.exists(config_path):
-            shutil.move(config_path, config_out)
-        else:
-            log.info(f'no path {config_path}')
-            exec_command(['ls', '-l', '/'])
-            exec_command(['ls', '-l', '/flywheel'])
-            exec_command(['ls', '-l', '/flywheel/v0'])
-
-
-if __name__ == '__main__':
-    debug2()
 
+if __name__ == '__main__' and os.environ.get('MRI_QA_DEBUG'):
+    import sys
 
+    paths = sys.argv[1:]
+    if not paths or len(paths) % 2:
+        sys.exit('usage: MRI_QA_DEBUG=1 {} <original> <corrected> [<original> <corrected> ...]'.format(sys.argv[0]))
+    debug(list(zip(paths[::2], paths[1::2])))
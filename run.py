@@ -3,13 +3,21 @@
 
 import json
 import os
+import contextlib
+import functools
 import logging
-import flywheel
-from common import exec_command, build_command_list
+import multiprocessing
+from pathlib import Path
+from common import exec_command, build_command_list, move_file
 import nibabel as nb
 import numpy as np
-import mri_qa
-import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# orjson parses the gear environment faster, but the stdlib json works just as well without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 
@@ -32,6 +40,25 @@ environ_json = '/tmp/gear_environ.json'
 ##--------    Gear Specific files/folders   --------##
 DEFAULT_CONFIG = '/flywheel/v0/b02b0.cnf'
 
+# Text files larger than this aren't echoed to the log
+MAX_LOGGED_FILE_SIZE = 64 * 1024
+
+@functools.lru_cache(maxsize=1)
+def load_environ(mtime):
+    """Reads the docker environment saved in the environment.json file
+
+    Args:
+        mtime (int): the file's modification time, so that the cached result is only reused for an unchanged file
+
+    Returns:
+        environ (dict): the environment variables
+    """
+    with open(environ_json, 'rb') as f:
+        environ_bytes = f.read()
+
+    return (orjson.loads(environ_bytes) if orjson else json.loads(environ_bytes))
+
+
 def set_environment(log):
     """Sets up the docker environment saved in a environment.json file
 
@@ -44,20 +71,53 @@ def set_environment(log):
 
 
 
-    # If it exists, read the file in as a python dict with json.load
-    with open(environ_json, 'r') as f:
-        log.info('Loading gear environment')
-        environ = json.load(f)
+    # If it exists, read the file in as a python dict (reusing the last read if the file hasn't changed since)
+    log.info('Loading gear environment')
+    environ = load_environ(os.stat(environ_json).st_mtime_ns)
 
     # Now set the current environment using the keys.  This will automatically be used with any sp.run() calls,
     # without the need to pass in env=...  Passing env= will unset all these variables, so don't use it if you do it
     # this way.
-    for key in environ.keys():
-        os.environ[key] = environ[key]
+    os.environ.update({key: str(value) for key, value in environ.items()})
 
     # Pass back the environ dict in case the run.py program has need of it later on.
     return environ
 
+def log_text_file(path, message):
+    """Writes the contents of a text file to the debug log
+
+    The file is only read when debug logging is enabled, and files over MAX_LOGGED_FILE_SIZE aren't read at all.
+
+    Args:
+        path (str): path to the text file
+        message (str): the log message, with a '%s' where the file contents go
+
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+
+    size = os.stat(path).st_size
+    if size > MAX_LOGGED_FILE_SIZE:
+        log.debug('Not logging %s (%s bytes)', path, size)
+        return
+
+    log.debug(message, Path(path).read_text(encoding='utf-8', errors='replace'))
+
+
+@functools.lru_cache(maxsize=None)
+def image_shape(image):
+    """Reads the shape of an image from its header.  Results are cached, so each image's header is only read once.
+
+    Args:
+        image (str): path to image
+
+    Returns:
+        (tuple): the image's shape
+
+    """
+    return (nb.load(image, mmap=True).shape)
+
+
 def is4D(image):
     """Checks to see if a given image is 4D
 
@@ -68,7 +128,8 @@ def is4D(image):
         (bool): true if image is 4d, false otherwise.
 
     """
-    shape = nb.load(image).header.get_data_shape()
+    shape = image_shape(image)
+
     if len(shape) < 4:
         return(False)
     elif shape[3] > 1:
@@ -77,6 +138,28 @@ def is4D(image):
         return(False)
 
 
+def load_volume(image, index=0):
+    """Reads a single volume of an image, without loading the rest of a 4D series
+
+    Args:
+        image (str): path to image
+        index (int): the volume to read if the image is 4D
+
+    Returns:
+        img (class: `nibabel.nifti1.Nifti1Image`): the image the volume was read from
+        volume (numpy.ndarray): the volume's 3D data.  Unless the image has scaling (scl_slope/scl_inter) to apply,
+            this is in the image's on-disk data type
+
+    """
+    img = nb.load(image, mmap=True)
+    if len(img.shape) > 3:
+        volume = np.asanyarray(img.dataobj[..., index])
+    else:
+        volume = np.asanyarray(img.dataobj)
+
+    return (img, volume)
+
+
 def check_inputs(context):
     """Check gear inputs
 
@@ -87,8 +170,9 @@ def check_inputs(context):
         context (class: `flywheel.gear_context.GearContext`): flywheel gear context
 
     Returns:
-        apply_to_files (list): a list of files to apply the TOPUP correction to after calculating the TOPUP fieldmaps
-        index_list (list): the row index in the acquisition_parameters file associated with each file in apply_to_files
+        apply_to_files (list): a list of (file, row) tuples to apply the TOPUP correction to after calculating the TOPUP
+        fieldmaps, where row is the row in the acquisition_parameters file associated with the file
+        is4d_map (dict): whether image_1 and image_2 (if provided) are 4D, keyed by their paths
     """
 
 
@@ -103,47 +187,72 @@ def check_inputs(context):
     apply_to_b = context.get_input_path('apply_to_2')
     acq_par = context.get_input_path('acquisition_parameters')
 
+    is4d_map = {image1_path: is4D(image1_path)}
+    if image2_path:
+        is4d_map[image2_path] = is4D(image2_path)
+
+    # Without image_2, image_1 must be a 4D image holding at least 2 volumes, one per row of the acquisition
+    # parameters (e.g. both PE directions in one series).  topup corrects all of its volumes itself (--iout), so
+    # there's nothing to apply.
+    if not image2_path:
+        n_volumes = image_shape(image1_path)[3] if is4d_map[image1_path] else 1
+        with open(acq_par, 'r') as parameters:
+            n_rows = len([row for row in parameters if row.strip()])
+        if n_volumes < 2 or n_volumes != n_rows:
+            raise Exception('image_2 was not provided, so image_1 must have at least 2 volumes, one for each of the {} '
+                            'rows in acquisition_parameters, but it has {}'.format(n_rows, n_volumes))
+        log.info('Using all %s volumes of %s as the topup input', n_volumes, image1_path)
+
+        # QA reports are only made for files run through applytopup, and here that's just the apply_to inputs
+        if not (apply_to_a or apply_to_b) and not context.config['topup_only']:
+            if context.config['QA']:
+                log.warning('image_2 was not provided, so image_1 is not run through applytopup and no QA report '
+                            'will be produced.  Provide apply_to_1 or apply_to_2 to get QA reports.')
+            else:
+                log.info('image_2 was not provided, so image_1 is not run through applytopup')
+
     # If image_1 is 4D, we will apply topup correction to the entire series after running topup
-    if is4D(image1_path):
+    elif is4d_map[image1_path]:
         apply_to_files.append((image1_path, '1')) # '1' Referring to the row this image is associated with in the "acquisition_parameters" file
-        log.info('Will run applytopup on {}'.format(image1_path))
+        log.info('Will run applytopup on %s', image1_path)
 
     # If image_2 is 4D, we will apply topup correction to the entire series after running topup
-    if is4D(image2_path):
+    if image2_path and is4d_map[image2_path]:
         apply_to_files.append((image2_path,'2'))
-        log.info('Will run applytopup on {}'.format(image2_path))
+        log.info('Will run applytopup on %s', image2_path)
 
     # If apply_to_a is provided, applytopup to this image, too.
     # NOTE that apply_to_a must correspond to row 1 in the acquisition_parameters file
     if apply_to_a:
         apply_to_files.append((apply_to_a,'1'))
-        log.info('Will run applytopup on {}'.format(apply_to_a))
+        log.info('Will run applytopup on %s', apply_to_a)
 
     # If apply_to_b is provided, applytopup to this image, too.
     # NOTE that apply_to_b must correspond to row 2 in the acquisition_parameters file
     if apply_to_b:
         apply_to_files.append((apply_to_b,'2'))
-        log.info('Will run applytopup on {}'.format(apply_to_b))
+        log.info('Will run applytopup on %s', apply_to_b)
 
-    # Read in the parameters and print them to the log
-    parameters = open(acq_par, 'r')
-    log.info(parameters.read())
-    parameters.close()
+    # Print the parameters to the debug log
+    log_text_file(acq_par, 'Acquisition parameters:\n\n%s\n\n')
 
 
     if config_path:
-        log.info('Using config settings in {}'.format(config_path))
+        log.info('Using config settings in %s', config_path)
     else:
         log.info('Using default config values')
 
-    return (apply_to_files)
+    return (apply_to_files, is4d_map)
 
 
-def generate_topup_input(context):
+def generate_topup_input(context, is4d_map):
     """Takes gear input files and generates a merged input file for TOPUP.
 
+    If image_2 wasn't provided, image_1 already holds all of topup's input volumes (see check_inputs) and is used as is.
+
     Args:
         context (class: `flywheel.gear_context.GearContext`): flywheel gear context
+        is4d_map (dict): whether image_1 and image_2 are 4D, keyed by their paths (from check_inputs)
 
     Returns:
         merged (string): the path to the merged file for use in TOPUP
@@ -157,39 +266,30 @@ def generate_topup_input(context):
     image2_path = context.get_input_path('image_2')
     work_dir = context.work_dir
 
-    # Create a base directory in the context's working directory for image 1
-    base_out1 = os.path.join(work_dir, 'Image1')
+    if not image2_path:
+        return (image1_path)
 
-    # If image 1 is 4D, we will only use the first volume (Assuming that a 4D image is fMRI and we only need one volume)
+    # If an image is 4D, we will only use the first volume (Assuming that a 4D image is fMRI and we only need one volume)
     # TODO: Allow the user to choose which volume to use for topup correction
-    if is4D(image1_path):
-        im_name = os.path.split(image1_path)[-1]
-        log.info('Using volume 1 in 4D image {}'.format(im_name))
-
-        # Generate a command to extract the first volume
-        cmd = ['fslroi', image1_path, base_out1, '0', '1']
-    else:
-        # If the image is 3D, simply copy the image to our working directory using fslmaths because it's extension agnostic
-        cmd = ['fslmaths', image1_path, base_out1]
-
-    # Execute the command, resulting in a single volume from image_1 in the working directory
-    exec_command(cmd)
+    for image_path in [image1_path, image2_path]:
+        if is4d_map[image_path]:
+            im_name = os.path.split(image_path)[-1]
+            log.info('Using volume 1 in 4D image %s', im_name)
 
-    # Repeat the same steps with image 2
-    base_out2 = os.path.join(work_dir, 'Image2')
-    if is4D(image2_path):
-        im_name = os.path.split(image2_path)[-1]
-        log.info('Using volume 1 in 4D image {}'.format(im_name))
+    img1, volume1 = load_volume(image1_path)
+    img2, volume2 = load_volume(image2_path)
 
-        cmd = ['fslroi', image2_path, base_out2, '0', '1']
-    else:
-        cmd = ['fslmaths', image2_path, base_out2]
-    exec_command(cmd)
-
-    # Merge the two volumes (image_1 then image_2)
+    # Merge the two volumes (image_1 then image_2) straight into topup's input, using image_1's header.  The merged
+    # array is allocated once, in the volumes' own type, so unscaled integer data is never upcast to float
     merged = os.path.join(work_dir, 'topup_vols')
-    cmd = ['fslmerge', '-t', merged, base_out1, base_out2]
-    exec_command(cmd)
+    merged_data = np.empty(volume1.shape + (2,), dtype=np.result_type(volume1, volume2))
+    merged_data[..., 0] = volume1
+    merged_data[..., 1] = volume2
+
+    # Write image_1's on-disk type; nibabel works out scl_slope/scl_inter for it if the inputs were scaled
+    merged_img = nb.Nifti1Image(merged_data, img1.affine, img1.header)
+    merged_img.set_data_dtype(img1.get_data_dtype())
+    merged_img.to_filename(merged + '.nii.gz')
 
     return (merged)
 
@@ -226,31 +326,23 @@ def run_topup(context, input):
     logout = os.path.join(output_dir, 'topup-log.txt')
 
     # Get output options from the gear context (which commands to include in the topup call)
-    dfout = context.config['displacement_field']
-    jacout = context.config['jacobian_determinants']
-    rbmout = context.config['rigid_body_matrix']
-    verbose = context.config['verbose']
-    debug = context.config['topup_debug_level']
-    # lout = context.config['mystery_output']
+    config = context.config
+    # lout = config['mystery_output']
 
     # Begin generating the command arguments with the default commands that are always present
     argument_dict = {'imain': input, 'datain': acq_par, 'out': out, 'fout': fout,
                      'iout': iout, 'logout': logout, 'config': config_path}
 
     # Add the optional commands defined by the user in the config settings
-    if dfout:
-        argument_dict['dfout'] = out + '-dfield'
-    if jacout:
-        argument_dict['jacout'] = out + '-jacdet'
-    if rbmout:
-        argument_dict['rbmout'] = out + '-rbmat'
-    if verbose:
-        argument_dict['verbose'] = True
-    if debug:
-        argument_dict['debug'] = debug
-
-    # Print the config file settings to the log
-    log.info('Using config settings:\n\n{}\n\n'.format(open(config_path, 'r').read()))
+    optional_arguments = {'dfout': out + '-dfield' if config['displacement_field'] else None,
+                          'jacout': out + '-jacdet' if config['jacobian_determinants'] else None,
+                          'rbmout': out + '-rbmat' if config['rigid_body_matrix'] else None,
+                          'verbose': True if config['verbose'] else None,
+                          'debug': config['topup_debug_level']}
+    argument_dict.update({key: value for key, value in optional_arguments.items() if value})
+
+    # Print the config file settings to the debug log
+    log_text_file(config_path, 'Using config settings:\n\n%s\n\n')
 
     # Build the command and execute
     command = build_command_list(['topup'], argument_dict)
@@ -262,21 +354,23 @@ def run_topup(context, input):
 def apply_topup(context, apply_topup_files, topup_out):
     """Applies a calculated topup correction to a list of files.
 
+    The corrections run concurrently, and each file is handed back as soon as its own correction finishes, so that
+    later steps (QA) can start on it while the others are still running.
+
     Args:
         context (class: `flywheel.gear_context.GearContext`): flywheel gear context
-        apply_topup_files (list): A list of files to apply topup correction to
-        index_list (list): A list that corresponds 1:1 with apply_topup_files, this indicates which row to use from the
-        "acquisition_parameters" text file for the associated file.  This essentially tells topup what PE direction each
-        image is.
+        apply_topup_files (list): A list of (file, row) tuples to apply topup correction to.  The row indicates which
+        row to use from the "acquisition_parameters" text file for the associated file.  This essentially tells topup
+        what PE direction each image is.
         topup_out (string): the base directory/filename for the topup analysis that was run previously.
 
-    Returns:
-        output_files (list): a list of topup corrected files
+    Yields:
+        (original, corrected) (tuple): an input file and its topup corrected file, in the order they finish
 
     """
     # Get the acquisition parameter file for the "--datain" option of topup
     acq_par = context.get_input_path('acquisition_parameters')
-    output_files = []
+    commands = []
 
     # For all the files we're applying topup to, loop through them with their associated row in the acquisition parameter file
     for fl, ix in apply_topup_files:
@@ -284,7 +378,6 @@ def apply_topup(context, apply_topup_files, topup_out):
         # Generate an output name: "topup_corrected_" appended to the front of the original filename
         base = os.path.split(fl)[-1]
         output_file = os.path.join(context.output_dir, 'topup-corrected-{}'.format(base))
-        output_files.append(output_file)
 
         # Generate the applytopup command
         cmd = ['applytopup',
@@ -295,11 +388,34 @@ def apply_topup(context, apply_topup_files, topup_out):
                '--method=jac',
                '--interp=spline',
                '--out={}'.format(output_file)]
+        commands.append((cmd, fl, output_file))
+
+    if not commands:
+        return
+
+    # Each applytopup is an independent process, so run them side by side (unless the user asked for one at a time)
+    if context.config['parallel_apply']:
+        max_workers = min(len(commands), os.cpu_count() or 1)
+    else:
+        max_workers = 1
 
-        # Execute the command
-        exec_command(cmd)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(exec_command, cmd): (fl, output_file) for cmd, fl, output_file in commands}
+        for future in as_completed(futures):
+            future.result()
+            yield futures[future]
 
-    return (output_files)
+
+def init_qa_worker(level):
+    """Sets a QA worker process's log level to the gear's
+
+    Args:
+        level (int): the log level to use
+
+    Returns: None
+
+    """
+    logging.getLogger().setLevel(level)
 
 
 def main():
@@ -313,12 +429,18 @@ def main():
 
     """
 
+    # The SDK pulls in a large dependency tree and only the gear context is needed from it, so it's imported here
+    import flywheel
+
     # shutil.copy('config.json','/flywheel/v0/output/config.json')
     with flywheel.gear_context.GearContext() as gear_context:
         log.setLevel(gear_context.config['gear-log-level'])
 
         gear_context.log_config()  # not configuring the log but logging the config
 
+        # Input paths don't change during a run, so only look each one up in the gear config once
+        gear_context.get_input_path = functools.lru_cache(maxsize=None)(gear_context.get_input_path)
+
         # Now let's set up our environment from the .json file stored in the docker image:
         log.info('setting up gear environment')
         try:
@@ -333,7 +455,7 @@ def main():
         # Check the inputs and categorize files
         log.info('Checking inputs')
         try:
-            apply_to_files = check_inputs(gear_context)
+            apply_to_files, is4d_map = check_inputs(gear_context)
         except Exception as e:
             raise Exception("Error with input validation") from e
 
@@ -341,7 +463,7 @@ def main():
         # Generate the input necessary for TOPUP
         log.info('Generating topup input')
         try:
-            topup_input = generate_topup_input(gear_context)
+            topup_input = generate_topup_input(gear_context, is4d_map)
         except Exception as e:
             raise Exception("Error generating topup inputs") from e
 
@@ -355,30 +477,47 @@ def main():
 
 
 
-        # Try to apply topup to input files
-        try:
-            if not gear_context.config['topup_only']:
-                log.info('Applying Topup Correction')
-                corrected_files = apply_topup(gear_context, apply_to_files, topup_out)
-        except Exception as e:
-            raise Exception("Error applying topup to inputs") from e
-
-
+        # Try to apply topup to input files.  QA reports are generated in separate processes (matplotlib isn't thread
+        # safe), each starting as soon as its corrected file is ready.  The workers come from a forkserver rather than
+        # being forked from here: a fork while apply_topup's threads are starting the next applytopup could leave its
+        # pipes held open by a QA worker, and that applytopup's output would never reach EOF.
+        # The pool (and the helper processes behind it) is only started when there will be QA to run.
         #TODO: Make this run on the input images, PLUS any corrected images
-
-        # Try to run topup QA
-        # apply_to_files is currently a list of [(filename, index), ... ].  We need to combine this
-        # with corrected files so that we have [(original file, corrected file), ... ]
-        file_comparison = [(apply_to_files[i][0], corrected_files[i]) for i in range(len(corrected_files))]
-
-        try:
-            if gear_context.config['QA']:
-                log.info('Running Topup QA')
-                for original, corrected in file_comparison:
-                    report_out = mri_qa.generate_topup_report(original, corrected, work_dir)
+        run_qa = gear_context.config['QA'] and not gear_context.config['topup_only']
+        if run_qa:
+            # Only pull in the QA dependencies (scipy, Pillow, matplotlib) when there will be QA
+            try:
+                import mri_qa
+            except Exception as e:
+                raise Exception("Error loading topup QC dependencies") from e
+
+            qa_workers = max(1, min(len(apply_to_files), os.cpu_count() or 1))
+            qa_pool = ProcessPoolExecutor(max_workers=qa_workers, mp_context=multiprocessing.get_context('forkserver'),
+                                          initializer=init_qa_worker, initargs=(log.getEffectiveLevel(),))
+        else:
+            qa_pool = contextlib.nullcontext()
+
+        with qa_pool as qa_executor:
+            qa_reports = []
+            try:
+                if not gear_context.config['topup_only']:
+                    log.info('Applying Topup Correction')
+                    for original, corrected in apply_topup(gear_context, apply_to_files, topup_out):
+                        if run_qa:
+                            log.info('Running Topup QA on %s', corrected)
+                            qa_reports.append(qa_executor.submit(mri_qa.generate_topup_report,
+                                                                 original, corrected, work_dir))
+            except Exception as e:
+                raise Exception("Error applying topup to inputs") from e
+
+            # Try to collect the topup QA
+            try:
+                for report in as_completed(qa_reports):
+                    report_out = report.result()
                     report_dir, report_base = os.path.split(report_out)
-                    shutil.move(report_out, os.path.join(output_dir, report_base))
+                    move_file(report_out, os.path.join(output_dir, report_base))
 
+                if qa_reports:
                     # Move the config file used in the analysis to the output
                     config_path = gear_context.get_input_path('config_file')
 
@@ -387,13 +526,12 @@ def main():
                         config_path = DEFAULT_CONFIG
                         config_out = os.path.join(output_dir, 'config_file.txt')
                         if os.path.exists(config_path):
-                            shutil.move(config_path, config_out)
+                            move_file(config_path, config_out)
                         else:
-                            log.info(f'no path {config_path}')
+                            log.info('no path %s', config_path)
 
-
-        except Exception as e:
-            raise Exception("Error running topup QC") from e
+            except Exception as e:
+                raise Exception("Error running topup QC") from e
 
 
 